@@ -1,9 +1,19 @@
 import os
 import cv2
+import functools
+import math
 import time
+import queue
+import threading
 import numpy  # For some colormap effects if needed
 import tkinter as tk
 from tkinter import filedialog
+try:
+    from numba import njit
+except ImportError: # numba is optional, the measurement helpers then run as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]): return args[0]
+        return lambda func: func
 
 
 # Helper function to convert FourCC integer to string for printing
@@ -15,21 +25,125 @@ def fourcc_to_string(fourcc_int):
     except Exception: return str(fourcc_int)
     return None
 
-def ask_for_save_path(initial_dir, title, file_types, default_extension):
-    """Opens a 'Save As' dialog and returns the selected path."""
-    root = tk.Tk()
-    root.withdraw()  # Hide the main Tkinter window
-    
+def ask_for_save_path(root, initial_dir, title, file_types, default_extension):
+    """Opens a 'Save As' dialog owned by the (hidden) Tk root and returns the selected path."""
     filepath = filedialog.asksaveasfilename(
+        parent=root,
         initialdir=initial_dir,
         title=title,
         filetypes=file_types,
         defaultextension=default_extension
     )
-    
-    root.destroy()  # Clean up the Tkinter instance
+    root.update() # Process the dialog's unmap, Tk's event loop doesn't run again until the next dialog
     return filepath
 
+def open_video_writer(filepath, fps, frame_size):
+    """Opens a VideoWriter on a hardware H.264 encoder (NVENC/QSV/VideoToolbox...) through FFMPEG when one is
+    available, so encoding doesn't compete with the UI for CPU. FFMPEG itself may settle on a software H.264
+    encoder; without FFMPEG H.264 support it falls back to the CPU 'mp4v' encoder.
+    Returns (video_writer, encoder description); check video_writer.isOpened()."""
+    if hasattr(cv2, "VIDEOWRITER_PROP_HW_ACCELERATION"): # OpenCV 4.5.2+
+        params = [cv2.VIDEOWRITER_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY,
+                  cv2.VIDEOWRITER_PROP_HW_ACCELERATION_USE_OPENCL, 0]
+        video_writer = cv2.VideoWriter(filepath, cv2.CAP_FFMPEG, cv2.VideoWriter_fourcc(*'avc1'), fps, frame_size, params)
+        if video_writer.isOpened():
+            # ANY silently falls back to software, the property reports what was actually picked
+            hw_acceleration = int(video_writer.get(cv2.VIDEOWRITER_PROP_HW_ACCELERATION))
+            if hw_acceleration == cv2.VIDEO_ACCELERATION_NONE: return video_writer, "software H.264"
+            return video_writer, "hardware H.264"
+    return cv2.VideoWriter(filepath, cv2.VideoWriter_fourcc(*'mp4v'), fps, frame_size), "CPU mp4v"
+
+MAX_DRAIN_GRABS = 8 # Driver queues are usually ~4 frames deep; bounds the drain if fps is misreported
+
+def grab_latest(cap, fps):
+    """Grabs until the driver queue is empty, then decodes the last grabbed frame.
+    A grab() served from the queue returns almost immediately, one that has to wait for
+    the sensor takes about a frame period, so stop once a grab() takes longer than half of one.
+    Gives up after MAX_DRAIN_GRABS grabs (a camera faster than the reported fps never blocks that long)."""
+    for _ in range(MAX_DRAIN_GRABS):
+        t0 = time.perf_counter()
+        if not cap.grab(): return False, None
+        if time.perf_counter() - t0 > 0.5 / fps: break
+    return cap.retrieve()
+
+class CameraThread(threading.Thread):
+    """Reads frames in the background and keeps only the newest one, so a slow
+    display or encoder iteration never leaves frames piling up in the driver."""
+    def __init__(self, cap, fps, flush_driver_buffer=False):
+        super().__init__(daemon=True)
+        self.cap = cap
+        self.fps = fps
+        self.flush_driver_buffer = flush_driver_buffer
+        self.latest = None
+        self.lock = threading.Lock()
+        self.new_frame = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            if self.flush_driver_buffer: ret, frame = grab_latest(self.cap, self.fps)
+            else: ret, frame = self.cap.read()
+            with self.lock:
+                if ret: self.latest = frame
+                else: self.stopped.set()
+                self.new_frame.set()
+            if not ret: break
+        self.stopped.set()
+        self.new_frame.set() # Wake up a get() still waiting
+
+    def get(self, timeout=0.5):
+        """Waits up to `timeout` seconds for a frame newer than the last one returned, and as long as
+        it takes for the first one (some cameras need seconds to start streaming).
+        Returns the newest frame, or None once the camera stopped delivering frames.
+        cap.read() hands out a fresh array every call, so no copy is needed."""
+        while not self.new_frame.wait(timeout) and self.latest is None and not self.stopped.is_set(): pass
+        with self.lock:
+            self.new_frame.clear()
+            return None if self.stopped.is_set() else self.latest
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class RecorderThread(threading.Thread):
+    """Encodes frames in the background so video_writer.write() can't stall the display loop.
+    pre_roll frames are passed through render(frame) (if given) and written first, while up to
+    max_pending live frames queue up behind them. If the encoder falls further behind, the oldest is dropped."""
+    def __init__(self, video_writer, pre_roll=(), render=None, max_pending=1):
+        super().__init__(daemon=True)
+        self.video_writer = video_writer
+        self.pre_roll = pre_roll
+        self.render = render
+        self.frames = queue.Queue(maxsize=max(1, max_pending))
+        self.stopped = threading.Event()
+
+    def put(self, frame):
+        """Queues `frame` for encoding. The caller must not modify it afterwards."""
+        if self.frames.full():
+            try: self.frames.get_nowait() # Drop the oldest pending frame, the encoder is behind
+            except queue.Empty: pass
+        self.frames.put_nowait(frame)
+
+    def run(self):
+        try:
+            for frame in self.pre_roll: self.video_writer.write(self.render(frame) if self.render else frame)
+            self.pre_roll = () # Done with the caller's buffer
+            while True:
+                try: frame = self.frames.get(timeout=0.1)
+                except queue.Empty:
+                    if self.stopped.is_set(): break
+                    continue
+                self.video_writer.write(frame)
+        finally:
+            self.pre_roll = ()
+            self.video_writer.release() # Finalize the file even if encoding failed
+
+    def stop(self, wait=True):
+        """Finishes the pre-roll and the pending frames, then releases the writer.
+        With wait=False it returns at once and the thread finishes in the background."""
+        self.stopped.set()
+        if wait: self.join()
+
 # --- Configuration ---
 CAMERA_INDEX = 0 # Try 0, 1, 2, etc.
 WINDOW_NAME = "Microscope Power Tools"
@@ -39,6 +153,12 @@ if not os.path.exists(CAPTURE_PATH):
     os.makedirs(CAPTURE_PATH)
     print(f"Created directory: {CAPTURE_PATH}")
 
+# Recordings start with up to this many seconds of camera frames from before 'r' was pressed (0 disables).
+# The buffer holds fps * seconds full resolution frames in RAM, capped at PRE_RECORD_MAX_MB together with the frames
+# queued for encoding (5s of 1080p30 would take ~900 MB, so it is shortened to what fits; the length is printed).
+PRE_RECORD_SECONDS = 5
+PRE_RECORD_MAX_MB = 512
+
 DISPLAY_WIDTH = 960 # Adjusted for more space for info text
 DISPLAY_HEIGHT = None
 
@@ -66,6 +186,39 @@ ANNOTATION_TEXT_COLOR = (255, 200, 200) # Light blue for annotation text
 # --- Visual Filters / Colormaps ---
 FILTER_MODES = ["Normal", "Grayscale", "Jet Colormap", "HSV Colormap", "Cool Colormap", "Channel Swap RGB", "Invert Colors"]
 current_filter_index = 0
+# Colormap filters as prebuilt 256-entry gray -> BGR tables; applyColorMap() with a user table skips rebuilding the built-in map every frame
+COLORMAP_LUTS = {name: cv2.applyColorMap(numpy.arange(256, dtype=numpy.uint8).reshape(256, 1), colormap)
+                 for name, colormap in (("Jet Colormap", cv2.COLORMAP_JET), ("HSV Colormap", cv2.COLORMAP_HSV), ("Cool Colormap", cv2.COLORMAP_COOL))}
+
+# --- CPU Optimizations ---
+# Keep OpenCV's SIMD code paths enabled. Official opencv-python(-contrib) >= 4.5 wheels pick AVX2/AVX-512 kernels
+# at runtime; when building OpenCV from source, configure it with
+#   -D CPU_BASELINE=SSE4_2 -D CPU_DISPATCH=AVX,AVX2,AVX512_SKX
+# or cvtColor/applyColorMap/resize are limited to the (SSE-only) baseline.
+cv2.setUseOptimized(True)
+
+def cpu_features_summary():
+    """Describes which instruction sets this OpenCV build was compiled for and which ones the CPU will use."""
+    info = [line.strip() for line in cv2.getBuildInformation().splitlines()]
+    summary = [line for line in info if line.startswith(("Baseline:", "Dispatched code generation:"))]
+    if hasattr(cv2, "getCPUFeaturesLine"): # '*' = dispatched and used on this CPU, '?' = not supported by this CPU
+        summary.append(f"Active: {cv2.getCPUFeaturesLine()}")
+    return " | ".join(" ".join(line.split()) for line in summary)
+
+# --- OpenCL ---
+# With an OpenCL device, the filter + resize chain runs on cv2.UMat (OpenCV's T-API) and the frame is only
+# downloaded for the overlays/display, recording and saving. Without one, the same code runs on NumPy arrays.
+USE_OPENCL = cv2.ocl.haveOpenCL()
+cv2.ocl.setUseOpenCL(USE_OPENCL)
+
+def new_frame_buffer(height, width, channels=3):
+    """Allocates an 8-bit per-frame buffer: a cv2.UMat on the OpenCL path, a NumPy array otherwise."""
+    if USE_OPENCL: return cv2.UMat(height, width, cv2.CV_8UC(channels))
+    return numpy.empty((height, width, channels) if channels > 1 else (height, width), numpy.uint8)
+
+def to_host(frame):
+    """Returns a new NumPy array with the contents of frame (NumPy array or cv2.UMat)."""
+    return frame.get() if isinstance(frame, cv2.UMat) else frame.copy()
 
 # --- Global State Variables ---
 # General
@@ -74,24 +227,50 @@ info_message = ""
 scale_x_display_to_original = 1.0
 scale_y_display_to_original = 1.0
 
+# Points are kept as (N, 2) int32 arrays (original frame coordinates) that can go to OpenCV in one call
 # Distance Measurement
-dist_measure_points = []
+dist_measure_points = numpy.zeros((2, 2), numpy.int32)
+dist_measure_count = 0 # Number of valid rows in dist_measure_points
 dist_measured_pixels = 0
 dist_measured_real = 0.0
 
 # Angle Measurement
-angle_measure_points = []
+angle_measure_points = numpy.zeros((3, 2), numpy.int32) # Row 0 is the vertex
+angle_measure_count = 0
 angle_measured_degrees = 0.0
 
 # Annotations
-annotations = [] # List of dicts: {'point': (x,y), 'text': "string"}
-current_annotation_text = ""
+annotation_points = numpy.empty((0, 2), numpy.int32)
+annotation_texts = [] # annotation_texts[i] is drawn next to annotation_points[i]
+annotations_version = 0 # Bumped whenever the annotations change, so their cached overlay sprite gets re-rendered
+current_annotation_text = bytearray() # Typed ASCII bytes, decoded only for drawing/saving
 current_annotation_point = None
 
 
+# --- Measurement Geometry ---
+# Compiled with numba when available: these also run on every mouse move for the live measurement preview.
+# The explicit signatures compile them at import time and accept both Python ints and the int32 point arrays.
+@njit("float64(float64, float64, float64, float64)", cache=True)
+def distance_px(p1x, p1y, p2x, p2y):
+    return math.hypot(p2x - p1x, p2y - p1y)
+
+@njit("float64(float64, float64, float64, float64, float64, float64)", cache=True)
+def angle_deg(p1x, p1y, p2x, p2y, p3x, p3y):
+    """Angle at vertex p1 between p1->p2 and p1->p3, in degrees (0-180).
+    atan2 needs no clamping and stays accurate near 0/180 degrees; atan2(0, 0) = 0 for coincident points."""
+    v1x, v1y = p2x - p1x, p2y - p1y
+    v2x, v2y = p3x - p1x, p3y - p1y
+    dot_product = v1x*v2x + v1y*v2y
+    cross_product = v1x*v2y - v1y*v2x
+    return math.degrees(math.atan2(abs(cross_product), dot_product))
+
+def format_distance(dist_pixels):
+    dist_real = dist_pixels / PIXELS_PER_REAL_UNIT if PIXELS_PER_REAL_UNIT > 0 else 0
+    return dist_real, f"Distance: {dist_real:.2f}{REAL_WORLD_UNIT_LABEL}"
+
 # --- Mouse Callback ---
 def mouse_events(event, x_click, y_click, flags, param):
-    global mode, dist_measure_points, angle_measure_points, current_annotation_point
+    global mode, dist_measure_count, angle_measure_count, current_annotation_point
     global dist_measured_pixels, dist_measured_real, angle_measured_degrees
     global scale_x_display_to_original, scale_y_display_to_original, info_message
 
@@ -101,31 +280,20 @@ def mouse_events(event, x_click, y_click, flags, param):
 
     if event == cv2.EVENT_LBUTTONDOWN:
         if mode == "distance_measure":
-            if len(dist_measure_points) < 2:
-                dist_measure_points.append((original_x, original_y))
-            if len(dist_measure_points) == 2:
-                p1, p2 = dist_measure_points[0], dist_measure_points[1]
-                dx, dy = p2[0] - p1[0], p2[1] - p1[1]
-                dist_measured_pixels = numpy.sqrt(dx**2 + dy**2)
-                dist_measured_real = dist_measured_pixels / PIXELS_PER_REAL_UNIT if PIXELS_PER_REAL_UNIT > 0 else 0
-                info_message = f"Distance: {dist_measured_real:.2f}{REAL_WORLD_UNIT_LABEL}"
+            if dist_measure_count < 2:
+                dist_measure_points[dist_measure_count] = (original_x, original_y)
+                dist_measure_count += 1
+            if dist_measure_count == 2:
+                p1, p2 = dist_measure_points
+                dist_measured_pixels = distance_px(p1[0], p1[1], p2[0], p2[1])
+                dist_measured_real, info_message = format_distance(dist_measured_pixels)
         elif mode == "angle_measure":
-            if len(angle_measure_points) < 3:
-                angle_measure_points.append((original_x, original_y))
-            if len(angle_measure_points) == 3:
-                p1, p2, p3 = angle_measure_points[0], angle_measure_points[1], angle_measure_points[2] # p1 is vertex
-                v1 = (p2[0] - p1[0], p2[1] - p1[1])
-                v2 = (p3[0] - p1[0], p3[1] - p1[1])
-                dot_product = v1[0]*v2[0] + v1[1]*v2[1]
-                mag_v1 = numpy.sqrt(v1[0]**2 + v1[1]**2)
-                mag_v2 = numpy.sqrt(v2[0]**2 + v2[1]**2)
-                if mag_v1 * mag_v2 == 0: # Avoid division by zero
-                    angle_measured_degrees = 0
-                else:
-                    cos_angle = dot_product / (mag_v1 * mag_v2)
-                    cos_angle = max(-1.0, min(1.0, cos_angle)) # Clamp to avoid domain errors with acos
-                    angle_rad = numpy.acos(cos_angle)
-                    angle_measured_degrees = numpy.degrees(angle_rad)
+            if angle_measure_count < 3:
+                angle_measure_points[angle_measure_count] = (original_x, original_y)
+                angle_measure_count += 1
+            if angle_measure_count == 3:
+                p1, p2, p3 = angle_measure_points # p1 is vertex
+                angle_measured_degrees = angle_deg(p1[0], p1[1], p2[0], p2[1], p3[0], p3[1])
                 info_message = f"Angle: {angle_measured_degrees:.2f} degrees"
         elif mode == "annotate_place_point":
             current_annotation_point = (original_x, original_y)
@@ -134,12 +302,190 @@ def mouse_events(event, x_click, y_click, flags, param):
             # Ideally, mouse callback shouldn't change global 'mode' directly affecting main loop logic this way
             # For more complex state, a state machine pattern would be better.
             param['change_mode_to'] = "annotate_type_text" # Pass mode change request via param
+    elif event == cv2.EVENT_MOUSEMOVE:
+        # Live preview: measure to the cursor while the last point is still missing
+        if mode == "distance_measure" and dist_measure_count == 1:
+            p1 = dist_measure_points[0]
+            _, preview = format_distance(distance_px(p1[0], p1[1], original_x, original_y))
+            info_message = preview + " (click to set)"
+        elif mode == "angle_measure" and angle_measure_count == 2:
+            p1, p2 = angle_measure_points[0], angle_measure_points[1]
+            info_message = f"Angle: {angle_deg(p1[0], p1[1], p2[0], p2[1], original_x, original_y):.2f} degrees (click to set)"
+
+# --- Filter Pipeline ---
+def new_filter_buffers(height, width):
+    """Allocates the per-frame buffers apply_filter() writes into, for frames of the given size."""
+    return {'size': (height, width),
+            'filtered': new_frame_buffer(height, width),
+            'gray': new_frame_buffer(height, width, 1)}
+
+def apply_filter(filter_name, frame, buffers, frame_size):
+    """Applies a FILTER_MODES filter to frame (NumPy array or cv2.UMat), writing into the reused buffers from
+    new_filter_buffers(). frame_size is the frame's (height, width), which a cv2.UMat doesn't expose; the buffers
+    are reallocated when it changes. Returned buffers are stored back in the dict.
+    "Normal" returns frame itself (no copy): anything that draws on the result must own it or copy it first."""
+    if filter_name != "Normal" and buffers['size'] != frame_size:
+        buffers.update(new_filter_buffers(*frame_size)) # mixChannels() can't resize its destination
+    if filter_name == "Grayscale":
+        buffers['gray'] = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=buffers['gray'])
+        buffers['filtered'] = cv2.cvtColor(buffers['gray'], cv2.COLOR_GRAY2BGR, dst=buffers['filtered']) # Keep 3 channels for consistency
+    elif filter_name in COLORMAP_LUTS:
+        buffers['gray'] = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=buffers['gray'])
+        buffers['filtered'] = cv2.applyColorMap(buffers['gray'], COLORMAP_LUTS[filter_name], dst=buffers['filtered'])
+    elif filter_name == "Channel Swap RGB":
+        # BGR -> GRB in one pass, no per-channel planes: source channel 0 -> 2, 1 -> 0, 2 -> 1
+        cv2.mixChannels([frame], [buffers['filtered']], [0, 2, 1, 0, 2, 1])
+    elif filter_name == "Invert Colors":
+        buffers['filtered'] = cv2.bitwise_not(frame, dst=buffers['filtered'])
+    else: # "Normal"
+        return frame
+    return buffers['filtered']
+
+# --- Overlay Drawing ---
+# Overlays that rarely change are rendered once into small cropped sprites and then only blitted each frame
+overlay_sprite_cache = {} # (name, image shape) -> (content key, sprite)
+
+def render_sprite(shape, draw):
+    """Renders draw(canvas, paint) into a sprite cropped to what was drawn, or None if nothing was.
+    draw is called twice: once in colour on a black canvas, and once with paint() returning 255 on a
+    single-channel canvas, which gives the antialiased coverage used to blend the sprite in blit_sprite()."""
+    canvas = numpy.zeros(shape, numpy.uint8)
+    draw(canvas, lambda color: color)
+    coverage = numpy.zeros(shape[:2], numpy.uint8)
+    draw(coverage, lambda color: 255)
+    x, y, w, h = cv2.boundingRect(coverage)
+    if w == 0 or h == 0: return None
+    inverse_alpha = cv2.cvtColor(255 - coverage[y:y+h, x:x+w], cv2.COLOR_GRAY2BGR)
+    return x, y, canvas[y:y+h, x:x+w].copy(), inverse_alpha
+
+def cached_sprite(name, shape, content_key, draw):
+    """Returns the sprite called name for images of this shape, re-rendering it only when content_key changed."""
+    cached = overlay_sprite_cache.get((name, shape))
+    if cached is None or cached[0] != content_key:
+        cached = (content_key, render_sprite(shape, draw))
+        overlay_sprite_cache[(name, shape)] = cached
+    return cached[1]
+
+def blit_sprite(img, sprite):
+    """Alpha-blends a sprite onto img, in place, clipped to the image. The sprite pixels were drawn on black,
+    so they are already multiplied by their coverage: img = img * (1 - alpha) + pixels."""
+    if sprite is None: return
+    x, y, pixels, inverse_alpha = sprite
+    h, w = pixels.shape[:2]
+    x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + w, img.shape[1]), min(y + h, img.shape[0])
+    if x0 >= x1 or y0 >= y1: return
+    roi = img[y0:y1, x0:x1]
+    cv2.multiply(roi, inverse_alpha[y0-y:y1-y, x0-x:x1-x], dst=roi, scale=1/255)
+    cv2.add(roi, pixels[y0-y:y1-y, x0-x:x1-x], dst=roi)
+
+@functools.lru_cache(maxsize=64)
+def render_text(text, font_scale, color, thickness):
+    """Rasterizes one line of text into a sprite sized by cv2.getTextSize, once per distinct argument set.
+    Returns (offset_x, offset_y, pixels, inverse_alpha) with offsets relative to the putText origin, or None."""
+    (w, h), baseline = cv2.getTextSize(text, TEXT_FONT, font_scale, thickness)
+    pad = thickness + 1 # Room for the antialiased edge
+    origin = (pad, pad + h)
+    def draw(canvas, paint): cv2.putText(canvas, text, origin, TEXT_FONT, font_scale, paint(color), thickness, cv2.LINE_AA)
+    sprite = render_sprite((h + baseline + 2*pad, w + 2*pad, 3), draw)
+    if sprite is None: return None
+    x, y, pixels, inverse_alpha = sprite
+    return x - origin[0], y - origin[1], pixels, inverse_alpha
+
+def draw_text(img, text, org, font_scale, color, thickness):
+    """Like cv2.putText with TEXT_FONT and LINE_AA, but blits a cached sprite instead of rasterizing the glyphs."""
+    sprite = render_text(text, font_scale, color, thickness)
+    if sprite is None: return
+    offset_x, offset_y, pixels, inverse_alpha = sprite
+    blit_sprite(img, (org[0] + offset_x, org[1] + offset_y, pixels, inverse_alpha))
+
+def draw_overlays(img, scale_x=1.0, scale_y=1.0):
+    """Draws the scale bar, mode/info text, measurements and annotations onto img.
+    Points are stored at original frame resolution; scale_x/scale_y map them onto img
+    (1.0 for a full resolution frame), and sizes follow scale_x."""
+    def to_img(p): return (int(p[0] * scale_x), int(p[1] * scale_y))
+    def to_img_array(points): return (points * (scale_x, scale_y)).astype(numpy.int32)
+    def size(v): return max(1, int(round(v * scale_x)))
+    filter_name = FILTER_MODES[current_filter_index]
+
+    # Scale Bar (never changes, rendered once per image size)
+    def draw_scale_bar(canvas, paint):
+        bar_start = to_img((MARGIN, original_frame_height - MARGIN))
+        bar_end = to_img((MARGIN + scale_bar_length_pixels, original_frame_height - MARGIN))
+        cv2.line(canvas, bar_start, bar_end, paint(SCALE_BAR_COLOR), size(SCALE_BAR_THICKNESS))
+        # ... (ticks for scale bar - can be added back if desired) ...
+        cv2.putText(canvas, f"{SCALE_BAR_LENGTH_REAL_UNITS} {REAL_WORLD_UNIT_LABEL}", to_img((MARGIN, original_frame_height - MARGIN - 10)), TEXT_FONT, TEXT_SCALE*scale_x, paint(TEXT_COLOR), size(TEXT_THICKNESS), cv2.LINE_AA)
+    blit_sprite(img, cached_sprite("scale_bar", img.shape, (scale_x, scale_y), draw_scale_bar))
+
+    # Mode/Info text (each distinct string is rasterized once, see render_text)
+    mode_display_text = f"Mode: {mode.replace('_', ' ')} | Filter: {filter_name}"
+    draw_text(img, mode_display_text, to_img((MARGIN, MARGIN + int(20*TEXT_SCALE/.5))), TEXT_SCALE*1.2*scale_x, (200,255,200), size(TEXT_THICKNESS))
+    if info_message:
+        draw_text(img, info_message, to_img((MARGIN, MARGIN + int(50*TEXT_SCALE/.5))), TEXT_SCALE*1.1*scale_x, (200,200,255), size(TEXT_THICKNESS))
+
+    # Measurements (re-rendered only when points are added or cleared)
+    def draw_measurements(canvas, paint):
+        # Distance Measurement Drawing
+        dist_points = to_img_array(dist_measure_points[:dist_measure_count])
+        for p in dist_points.tolist(): cv2.circle(canvas, p, size(POINT_RADIUS), paint(MEASURE_POINT_COLOR), -1)
+        if dist_measure_count == 2:
+            cv2.polylines(canvas, [dist_points], False, paint(MEASURE_LINE_COLOR), 1)
+
+        # Angle Measurement Drawing
+        angle_points = to_img_array(angle_measure_points[:angle_measure_count])
+        for p in angle_points.tolist(): cv2.circle(canvas, p, size(POINT_RADIUS), paint(MEASURE_POINT_COLOR), -1)
+        if angle_measure_count == 3:
+            cv2.polylines(canvas, [angle_points[[1, 0, 2]]], False, paint(MEASURE_LINE_COLOR), 1) # Both arms through the vertex
+            # Arc for angle (simplified)
+            # cv2.ellipse(canvas, angle_points[0], (30,30), ...) # More complex to draw nicely
+    measurements_key = (scale_x, scale_y, dist_measure_points[:dist_measure_count].tobytes(), angle_measure_points[:angle_measure_count].tobytes())
+    blit_sprite(img, cached_sprite("measurements", img.shape, measurements_key, draw_measurements))
+
+    # Annotations Drawing (one cached layer for all saved annotations, re-rendered when annotations_version changes)
+    def draw_annotations(canvas, paint):
+        points = to_img_array(annotation_points).tolist()
+        text_origins = to_img_array(annotation_points + (10, 5)).tolist()
+        for p, text_origin, text in zip(points, text_origins, annotation_texts):
+            cv2.circle(canvas, p, size(POINT_RADIUS-2), paint(ANNOTATION_POINT_COLOR), -1)
+            cv2.putText(canvas, text, text_origin, TEXT_FONT, TEXT_SCALE*scale_x, paint(ANNOTATION_TEXT_COLOR), size(TEXT_THICKNESS), cv2.LINE_AA)
+    blit_sprite(img, cached_sprite("annotations", img.shape, (scale_x, scale_y, annotations_version), draw_annotations))
+    if mode == "annotate_type_text" and current_annotation_point:
+        cv2.circle(img, to_img(current_annotation_point), size(POINT_RADIUS-1), (255,255,0), -1) # Highlight current point
+        draw_text(img, current_annotation_text.decode('ascii', 'ignore') + "|", to_img((current_annotation_point[0] + 10, current_annotation_point[1] + 5)), TEXT_SCALE*scale_x, (255,255,0), size(TEXT_THICKNESS))
+
+    # Recording Indicator
+    if is_recording:
+        cv2.circle(img, to_img((original_frame_width - MARGIN - 10, MARGIN + 10)), size(10), (0, 0, 255), -1)
+
+def render_overlay_snapshot(shape):
+    """Renders the current draw_overlays() output for full resolution frames of shape into one sprite, so other
+    threads can blit it later without reading the overlay state. Drawing on black gives the overlay pixels,
+    drawing on white as well gives the per-channel 1 - alpha blit_sprite() needs: white result - black result."""
+    black = numpy.zeros(shape, numpy.uint8)
+    draw_overlays(black)
+    white = numpy.full(shape, 255, numpy.uint8)
+    draw_overlays(white)
+    inverse_alpha = cv2.subtract(white, black)
+    x, y, w, h = cv2.boundingRect((inverse_alpha != 255).any(axis=2).astype(numpy.uint8))
+    if w == 0 or h == 0: return None
+    return x, y, black[y:y+h, x:x+w].copy(), inverse_alpha[y:y+h, x:x+w].copy()
+
+def render_recording_frame(frame, filter_name, buffers, overlay):
+    """Returns a new array with frame filtered and overlay (a render_overlay_snapshot() sprite) blitted on it.
+    Used by the recorder thread for the raw pre-roll frames, with buffers of its own."""
+    source_frame = cv2.UMat(frame) if USE_OPENCL else frame
+    record_frame = to_host(apply_filter(filter_name, source_frame, buffers, frame.shape[:2]))
+    blit_sprite(record_frame, overlay)
+    return record_frame
 
 # --- Main Program ---
 cap = cv2.VideoCapture(CAMERA_INDEX)
 if not cap.isOpened():
     print(f"Error: Could not open video device at index {CAMERA_INDEX}.")
     exit()
+# Keep at most one frame queued in the driver so cap.read() returns the newest frame, not one from ~4 frames ago
+flush_driver_buffer = not cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+if flush_driver_buffer:
+    print("Warning: Backend ignored CAP_PROP_BUFFERSIZE, stale frames will be flushed with grab().")
 
 original_frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
 original_frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -171,6 +517,7 @@ print(f"Scale: {PIXELS_PER_REAL_UNIT} px/{REAL_WORLD_UNIT_LABEL} | Bar: {SCALE_B
 
 is_recording = False
 video_writer = None
+recorder = None
 fps = cap.get(cv2.CAP_PROP_FPS)
 fps = float(fps) if fps and fps > 0 else 20.0
 
@@ -180,86 +527,90 @@ cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
 if display_w != original_frame_width or display_h != original_frame_height:
      cv2.resizeWindow(WINDOW_NAME, display_w, display_h)
 
+# One hidden Tk root for all save dialogs, instead of starting a new Tk interpreter for every dialog
+tk_root = tk.Tk()
+tk_root.withdraw()
+
 # Param dictionary for mouse callback to request mode changes
 mouse_callback_param = {'change_mode_to': None}
 cv2.setMouseCallback(WINDOW_NAME, mouse_events, mouse_callback_param)
 
-while True:
-    ret, frame_bgr_original = cap.read()
-    if not ret: break
+camera_thread = CameraThread(cap, fps, flush_driver_buffer)
+camera_thread.start()
+
+# Per-frame buffers, allocated once and filled in place with dst= instead of allocating new frames every iteration.
+# The preview is downscaled before filtering; the full resolution buffers are only used for recording and saving.
+needs_display_resize = display_w > 0 and display_h > 0 and (display_w != original_frame_width or display_h != original_frame_height)
+preview_h, preview_w = (display_h, display_w) if needs_display_resize else (original_frame_height, original_frame_width)
+display_source_buf = new_frame_buffer(preview_h, preview_w)
+display_filter_buffers = new_filter_buffers(preview_h, preview_w)
+full_filter_buffers = new_filter_buffers(original_frame_height, original_frame_width)
+
+# Ring buffer with the latest camera frames, allocated once; flushed to the file when recording starts
+def pre_record_budget_frames(frame_shape):
+    """Number of frames of frame_shape that fit in PRE_RECORD_MAX_MB."""
+    return PRE_RECORD_MAX_MB * 2**20 // math.prod(frame_shape)
+
+def new_pre_record_ring(fps, frame_shape):
+    """Allocates room for PRE_RECORD_SECONDS of frames of frame_shape. The ring gets at most 2/3 of
+    PRE_RECORD_MAX_MB, the rest is left for the live frames that queue up while the pre-roll is encoded."""
+    capacity = max(0, min(int(fps * PRE_RECORD_SECONDS), pre_record_budget_frames(frame_shape) * 2 // 3))
+    try: ring = numpy.empty((capacity,) + frame_shape, numpy.uint8)
+    except MemoryError:
+        print("Not enough memory for the pre-record buffer, pre-recording disabled.")
+        return numpy.empty((0,) + frame_shape, numpy.uint8)
+    if capacity: print(f"Pre-record buffer: {capacity / fps:.1f}s, {capacity} frames ({ring.nbytes / 2**20:.0f} MB)")
+    return ring
+
+pre_record_ring = new_pre_record_ring(fps, (original_frame_height, original_frame_width, 3))
+pre_record_capacity = len(pre_record_ring)
+pre_record_head = 0 # Slot the next frame goes into
+pre_record_count = 0 # Number of valid frames in the ring
+print(f"OpenCV {cv2.__version__}, optimized: {cv2.useOptimized()} | {cpu_features_summary()}")
+print(f"Filter pipeline: {'OpenCL (' + cv2.ocl.Device.getDefault().name() + ')' if USE_OPENCL else 'CPU'}")
 
-    # --- Apply Visual Filters/Colormaps First ---
-    processed_frame = frame_bgr_original.copy()
+while True:
+    frame_bgr_original = camera_thread.get()
+    if frame_bgr_original is None: break
+    # While recording, and until the last recorder is done with its pre-roll, the ring is being read
+    pre_record_ring_free = not is_recording and not (recorder and recorder.is_alive())
+    if pre_record_capacity and pre_record_ring_free:
+        if pre_record_ring.shape[1:] != frame_bgr_original.shape: # Camera delivers another size than it reported
+            pre_record_ring = None # Release the old ring before allocating the new one
+            pre_record_ring = new_pre_record_ring(fps, frame_bgr_original.shape)
+            pre_record_capacity = len(pre_record_ring)
+            pre_record_head = pre_record_count = 0
+    if pre_record_capacity and pre_record_ring_free:
+        numpy.copyto(pre_record_ring[pre_record_head], frame_bgr_original)
+        pre_record_head = (pre_record_head + 1) % pre_record_capacity
+        pre_record_count = min(pre_record_count + 1, pre_record_capacity)
+    source_frame = cv2.UMat(frame_bgr_original) if USE_OPENCL else frame_bgr_original
+    frame_size = frame_bgr_original.shape[:2] # Can differ from the size the camera reported
     filter_name = FILTER_MODES[current_filter_index]
 
-    if filter_name == "Grayscale":
-        gray = cv2.cvtColor(frame_bgr_original, cv2.COLOR_BGR2GRAY)
-        processed_frame = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR) # Keep 3 channels for consistency
-    elif filter_name == "Jet Colormap":
-        gray = cv2.cvtColor(frame_bgr_original, cv2.COLOR_BGR2GRAY)
-        processed_frame = cv2.applyColorMap(gray, cv2.COLORMAP_JET)
-    elif filter_name == "HSV Colormap":
-        gray = cv2.cvtColor(frame_bgr_original, cv2.COLOR_BGR2GRAY)
-        processed_frame = cv2.applyColorMap(gray, cv2.COLORMAP_HSV)
-    elif filter_name == "Cool Colormap":
-        gray = cv2.cvtColor(frame_bgr_original, cv2.COLOR_BGR2GRAY)
-        processed_frame = cv2.applyColorMap(gray, cv2.COLORMAP_COOL)
-    elif filter_name == "Channel Swap RGB":
-        b, g, r = cv2.split(frame_bgr_original)
-        processed_frame = cv2.merge((g, r, b)) # Example: BGR -> GRB
-    elif filter_name == "Invert Colors":
-        processed_frame = cv2.bitwise_not(frame_bgr_original)
-    # "Normal" mode uses processed_frame which is a copy of frame_bgr_original
-
-    overlay_frame = processed_frame.copy() # For drawing overlays at original resolution
-
-    # --- Drawing Overlays ---
-    # Scale Bar
-    bar_x_start = MARGIN; bar_y_pos = original_frame_height - MARGIN
-    cv2.line(overlay_frame, (bar_x_start, bar_y_pos), (bar_x_start + scale_bar_length_pixels, bar_y_pos), SCALE_BAR_COLOR, SCALE_BAR_THICKNESS)
-    # ... (ticks for scale bar - can be added back if desired) ...
-    cv2.putText(overlay_frame, f"{SCALE_BAR_LENGTH_REAL_UNITS} {REAL_WORLD_UNIT_LABEL}", (bar_x_start, bar_y_pos - 10), TEXT_FONT, TEXT_SCALE, TEXT_COLOR, TEXT_THICKNESS, cv2.LINE_AA)
-
-    # Mode/Info text
-    mode_display_text = f"Mode: {mode.replace('_', ' ')} | Filter: {filter_name}"
-    cv2.putText(overlay_frame, mode_display_text, (MARGIN, MARGIN + int(20*TEXT_SCALE/.5)), TEXT_FONT, TEXT_SCALE*1.2, (200,255,200), TEXT_THICKNESS, cv2.LINE_AA)
-    if info_message:
-        cv2.putText(overlay_frame, info_message, (MARGIN, MARGIN + int(50*TEXT_SCALE/.5)), TEXT_FONT, TEXT_SCALE*1.1, (200,200,255), TEXT_THICKNESS, cv2.LINE_AA)
-
-    # Distance Measurement Drawing
-    for i, p in enumerate(dist_measure_points): cv2.circle(overlay_frame, p, POINT_RADIUS, MEASURE_POINT_COLOR, -1)
-    if len(dist_measure_points) == 2:
-        cv2.line(overlay_frame, dist_measure_points[0], dist_measure_points[1], MEASURE_LINE_COLOR, 1)
-
-    # Angle Measurement Drawing
-    for i, p in enumerate(angle_measure_points): cv2.circle(overlay_frame, p, POINT_RADIUS, MEASURE_POINT_COLOR, -1)
-    if len(angle_measure_points) == 3:
-        cv2.line(overlay_frame, angle_measure_points[0], angle_measure_points[1], MEASURE_LINE_COLOR, 1)
-        cv2.line(overlay_frame, angle_measure_points[0], angle_measure_points[2], MEASURE_LINE_COLOR, 1)
-        # Arc for angle (simplified)
-        # cv2.ellipse(overlay_frame, angle_measure_points[0], (30,30), ...) # More complex to draw nicely
-
-    # Annotations Drawing
-    for ann in annotations:
-        cv2.circle(overlay_frame, ann['point'], POINT_RADIUS-2, ANNOTATION_POINT_COLOR, -1)
-        cv2.putText(overlay_frame, ann['text'], (ann['point'][0] + 10, ann['point'][1] + 5), TEXT_FONT, TEXT_SCALE, ANNOTATION_TEXT_COLOR, TEXT_THICKNESS, cv2.LINE_AA)
-    if mode == "annotate_type_text" and current_annotation_point:
-        cv2.circle(overlay_frame, current_annotation_point, POINT_RADIUS-1, (255,255,0), -1) # Highlight current point
-        cv2.putText(overlay_frame, current_annotation_text + "|", (current_annotation_point[0] + 10, current_annotation_point[1] + 5), TEXT_FONT, TEXT_SCALE, (255,255,0), TEXT_THICKNESS, cv2.LINE_AA)
-
-
-    # Recording Indicator
+    # --- Recording ---
+    if is_recording and not recorder.is_alive(): # The encoder failed, the recorder released what it wrote
+        is_recording = False
+        info_message = "Recording stopped: encoding failed!"
     if is_recording:
-        cv2.circle(overlay_frame, (original_frame_width - MARGIN - 10, MARGIN + 10), 10, (0, 0, 255), -1)
-        video_writer.write(overlay_frame) # Save frame with overlays
+        # Recordings keep the original resolution, so the filter runs a second time on the full frame
+        record_frame = to_host(apply_filter(filter_name, source_frame, full_filter_buffers, frame_size)) # New array each frame: the recorder thread may still be encoding the last one
+        draw_overlays(record_frame)
+        recorder.put(record_frame) # Save frame with overlays
 
     # --- Display ---
-    display_output_frame = overlay_frame
-    if (display_w != original_frame_width or display_h != original_frame_height):
-        if display_w > 0 and display_h > 0: # Ensure valid dimensions
-            display_output_frame = cv2.resize(overlay_frame, (display_w, display_h), interpolation=cv2.INTER_AREA)
-
-    cv2.imshow(WINDOW_NAME, display_output_frame)
+    # Downscale the camera frame first, then filter and draw the overlays at display size:
+    # (original_w * original_h) / (display_w * display_h) times fewer pixels to filter than at original resolution
+    if needs_display_resize:
+        display_source_buf = cv2.resize(source_frame, (display_w, display_h), dst=display_source_buf, interpolation=cv2.INTER_AREA)
+    else:
+        display_source_buf = cv2.copyTo(source_frame, None, dst=display_source_buf) # Own copy, the overlays are drawn on it in "Normal" mode
+    preview_size = (display_h, display_w) if needs_display_resize else frame_size
+    display_frame = apply_filter(filter_name, display_source_buf, display_filter_buffers, preview_size)
+    if USE_OPENCL: display_frame = display_frame.get() # Overlays are drawn with NumPy, so download just the small frame
+    draw_overlays(display_frame, 1 / scale_x_display_to_original, 1 / scale_y_display_to_original)
+
+    cv2.imshow(WINDOW_NAME, display_frame)
 
     # --- Key Handling ---
     # Check if mouse callback requested a mode change
@@ -267,27 +618,31 @@ while True:
         mode = mouse_callback_param['change_mode_to']
         mouse_callback_param['change_mode_to'] = None # Reset request
 
-    key_wait_time = 1 if mode != "annotate_type_text" else 30 # Shorter wait for typing
-    key = cv2.waitKey(key_wait_time) & 0xFF
+    # pollKey() (OpenCV 4.5+) returns at once instead of idling at least 1 ms; the loop is already paced by camera_thread.get().
+    # While typing, waitKey(30) keeps the UI responsive without missing keystrokes.
+    if mode != "annotate_type_text" and hasattr(cv2, 'pollKey'): key = cv2.pollKey() & 0xFF
+    else: key = cv2.waitKey(1 if mode != "annotate_type_text" else 30) & 0xFF
 
     if mode == "annotate_type_text":
         if key != 255: # 255 is no key pressed
             if key == 13: # Enter
                 if current_annotation_text and current_annotation_point:
-                    annotations.append({'point': current_annotation_point, 'text': current_annotation_text})
-                current_annotation_text = ""
+                    annotation_points = numpy.vstack((annotation_points, current_annotation_point)).astype(numpy.int32)
+                    annotation_texts.append(current_annotation_text.decode('ascii', 'ignore'))
+                    annotations_version += 1
+                current_annotation_text.clear()
                 current_annotation_point = None
                 mode = "normal"
                 info_message = "Annotation saved. Press 't' for new."
             elif key == 27: # Escape
-                current_annotation_text = ""
+                current_annotation_text.clear()
                 current_annotation_point = None
                 mode = "normal"
                 info_message = "Annotation cancelled."
             elif key == 8: # Backspace
-                current_annotation_text = current_annotation_text[:-1]
+                del current_annotation_text[-1:]
             elif 32 <= key <= 126: # Printable ASCII
-                current_annotation_text += chr(key)
+                current_annotation_text.append(key)
         # Continue in annotate_type_text mode until Enter/Esc
     else: # Normal key handling for other modes
         if key == ord('q'): break
@@ -296,6 +651,7 @@ while True:
             default_filename = f"capture_{ts}.png"
             
             filepath = ask_for_save_path(
+                tk_root,
                 initial_dir=CAPTURE_PATH,
                 title="Save Image As...",
                 file_types=(("PNG files", "*.png"), ("JPEG files", "*.jpg"), ("All files", "*.*")),
@@ -304,7 +660,9 @@ while True:
 
             # If the user selected a path (didn't cancel)
             if filepath:
-                cv2.imwrite(filepath, overlay_frame) # Save with overlays
+                save_frame = to_host(apply_filter(filter_name, source_frame, full_filter_buffers, frame_size))
+                draw_overlays(save_frame) # Save with overlays, at original resolution
+                cv2.imwrite(filepath, save_frame)
                 # Use os.path.basename to show just the filename in the message
                 info_message = f"Saved: {os.path.basename(filepath)}"
             else:
@@ -316,6 +674,7 @@ while True:
                 default_filename = f"video_{ts}.mp4"
                 
                 filepath = ask_for_save_path(
+                    tk_root,
                     initial_dir=CAPTURE_PATH,
                     title="Record Video As...",
                     file_types=(("MP4 files", "*.mp4"), ("AVI files", "*.avi"), ("All files", "*.*")),
@@ -323,11 +682,21 @@ while True:
                 )
 
                 if filepath:
-                    fourcc = cv2.VideoWriter_fourcc(*'X264') # or 'MP4V'
-                    video_writer = cv2.VideoWriter(filepath, fourcc, fps, (original_frame_width, original_frame_height))
+                    video_writer, encoder_name = open_video_writer(filepath, fps, (frame_size[1], frame_size[0])) # Size of the frames it will get
                     if video_writer.isOpened():
+                        if recorder: recorder.stop() # The previous recording may still be encoding its pre-roll
+                        oldest = pre_record_head - pre_record_count # Negative indices wrap around the ring
+                        pre_roll = [pre_record_ring[i] for i in range(oldest, pre_record_head)]
+                        # The pre-roll frames are raw camera frames: the recorder gives them the current filter and
+                        # a snapshot of the overlays as they are now, before "Recording to ..." and the REC dot
+                        render_pre_roll = functools.partial(render_recording_frame, filter_name=filter_name, buffers=new_filter_buffers(*frame_size),
+                                                            overlay=render_overlay_snapshot(frame_bgr_original.shape))
+                        # Live frames queue up while the pre-roll is encoded, in what the ring left of PRE_RECORD_MAX_MB
+                        max_pending = min(len(pre_roll), pre_record_budget_frames(frame_bgr_original.shape) - pre_record_capacity)
+                        recorder = RecorderThread(video_writer, pre_roll, render_pre_roll, max_pending)
+                        recorder.start()
                         is_recording = True
-                        info_message = f"Recording to {os.path.basename(filepath)}"
+                        info_message = f"Recording to {os.path.basename(filepath)} ({encoder_name})"
                     else:
                         info_message = "Error starting recording!"
                 else:
@@ -335,24 +704,25 @@ while True:
                 # -----------------------------------
             else:
                 is_recording = False
-                video_writer.release()
+                recorder.stop(wait=False) # Finishes the pending frames and releases video_writer in the background
+                pre_record_count = 0 # Those frames are in this recording already
                 info_message = "Recording stopped."
         elif key == ord('d'):
-            mode = "distance_measure"; dist_measure_points = []; info_message = "Distance Mode: Click 2 points."
+            mode = "distance_measure"; dist_measure_count = 0; info_message = "Distance Mode: Click 2 points."
         elif key == ord('a'):
-            mode = "angle_measure"; angle_measure_points = []; info_message = "Angle Mode: Click 3 points (Vertex first)."
+            mode = "angle_measure"; angle_measure_count = 0; info_message = "Angle Mode: Click 3 points (Vertex first)."
         elif key == ord('t'):
             mode = "annotate_place_point"; info_message = "Annotation Mode: Click to place text."
-            current_annotation_text = ""; current_annotation_point = None
+            current_annotation_text.clear(); current_annotation_point = None
         elif key == ord('c'): # Clear current tool's points
-            if mode == "distance_measure": dist_measure_points = []
-            elif mode == "angle_measure": angle_measure_points = []
+            if mode == "distance_measure": dist_measure_count = 0
+            elif mode == "angle_measure": angle_measure_count = 0
             # If in annotate_place_point or annotate_type_text and 'c' is pressed, cancel current
             elif mode.startswith("annotate"):
-                current_annotation_text = ""; current_annotation_point = None; mode = "normal"
+                current_annotation_text.clear(); current_annotation_point = None; mode = "normal"
             info_message = "Current points cleared."
         elif key == ord('C'): # Clear ALL annotations
-            annotations = []
+            annotation_points = annotation_points[:0]; annotation_texts = []; annotations_version += 1
             info_message = "All annotations cleared."
         elif key == ord('f'): # Cycle filters
             current_filter_index = (current_filter_index + 1) % len(FILTER_MODES)
@@ -361,6 +731,8 @@ while True:
              if mode == "normal" and info_message : info_message = "" # Clear info if in normal mode and a key is pressed
 
 
-if is_recording and video_writer: video_writer.release()
+if recorder: recorder.stop()
+camera_thread.stop()
 cap.release()
+tk_root.destroy()
 cv2.destroyAllWindows()